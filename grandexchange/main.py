@@ -1,13 +1,18 @@
-import requests
+import asyncio
+import httpx
 import time
 import logging
-import json
+import orjson
 import re
 import os
+import atexit
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 import pytz
-from bs4 import BeautifulSoup
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ReplaceOne, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +22,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger('grandexchange')
 
+# Shared MongoDB client, created lazily by get_mongo_client()
+_CLIENT = None
+
+# Shared HTTP client so all requests reuse one HTTP/2 connection per host
+_HTTP_CLIENT = httpx.AsyncClient(timeout=10, http2=True)
+
+# Timezone used for the human-readable gst field
+_GMT = pytz.timezone('GMT')
+
+# Conditional GET cache: url -> (etag, last_modified, parsed body)
+_http_cache = {}
+
+# Matches the number inside the <p class="player-count"> element of the OSRS homepage
+_PLAYER_RE = re.compile(rb'<p[^>]*class=["\'][^"\']*player-count[^"\']*["\'][^>]*>[^<]*?(\d{1,3}(?:,\d{3})*)')
+
+# Seconds between price collections
+FETCH_INTERVAL = 300
+
+# Number of documents sent per bulk_write call
+WRITE_BATCH_SIZE = 500
+
 # Define the columns we want to display
 WANTED_COLUMNS = [
     "item_name",
@@ -27,24 +53,37 @@ WANTED_COLUMNS = [
     "low_price_1h",
     "low_price_5m",
     "low_volume_1h",
-    "low_volume_5m",
+    "low_volume_5m"
+]
+
+# Per-cycle fields stored once in the snapshots collection rather than on every item
+SNAPSHOT_COLUMNS = [
     "player_count",
-    "timestampElapsed",
+    "timestamp_elapsed",
     "gst"
 ]
 
 def get_mongo_client():
-    """Create a connection to MongoDB."""
+    """Return the shared MongoDB client, connecting on first use."""
+    global _CLIENT
+    if _CLIENT is not None:
+        return _CLIENT
+
     retries = 5
     while retries > 0:
+        client = None
         try:
             mongo_uri = os.environ.get('MONGO_URI', 'mongodb://mongodb:27017/')
-            client = MongoClient(mongo_uri)
+            client = MongoClient(mongo_uri, maxPoolSize=50, serverSelectionTimeoutMS=5000, connect=False)
             # Ping the server to check connection
             client.admin.command('ping')
             logger.info("Successfully connected to MongoDB")
+            _CLIENT = client
+            atexit.register(client.close)
             return client
         except Exception as e:
+            if client is not None:
+                client.close()
             retries -= 1
             logger.warning(f"Could not connect to MongoDB, retrying... ({retries} attempts left): {e}")
             time.sleep(5)
@@ -66,8 +105,16 @@ def initialize_database():
         
         # Create indexes for better query performance
         price_coll = db.price_data
-        price_coll.create_index([("timestamp", ASCENDING)])
-        price_coll.create_index([("item_id", ASCENDING)])
+        try:
+            price_coll.create_index([("timestamp", ASCENDING), ("item_id", ASCENDING)], unique=True)
+        except OperationFailure as e:
+            # Older collections may already hold duplicate snapshots; keep the key indexed regardless
+            logger.warning(f"Could not create unique (timestamp, item_id) index: {e}")
+            price_coll.create_index([("timestamp", ASCENDING), ("item_id", ASCENDING)])
+        
+        snapshot_coll = db.snapshots
+        snapshot_coll.create_index([("timestamp", ASCENDING)], unique=True)
+        price_coll.create_index([("item_id", ASCENDING), ("collection_time", DESCENDING)])
         
         logger.info("MongoDB database initialized successfully")
         return True
@@ -76,92 +123,97 @@ def initialize_database():
         logger.error(f"Error initializing MongoDB: {e}")
         return False
 
+@lru_cache(maxsize=1)
+def read_item_mapping():
+    """Read the mapping from item IDs to names from mapping.json, raising on failure so errors aren't cached"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    mapping_path = os.path.join(script_dir, 'mapping.json')
+    
+    with open(mapping_path, 'rb') as f:
+        mapping_data = orjson.loads(f.read())
+    
+    # Create a dictionary mapping item ID to item name
+    item_id_to_name = {str(item['id']): item['name'] for item in mapping_data if 'id' in item and 'name' in item}
+    
+    logger.info(f"Loaded {len(item_id_to_name)} item mappings from mapping.json")
+    return item_id_to_name
+
 def load_item_mapping():
     """Load the mapping from item IDs to names from mapping.json"""
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        mapping_path = os.path.join(script_dir, 'mapping.json')
-        
-        with open(mapping_path, 'r') as f:
-            mapping_data = json.load(f)
-        
-        # Create a dictionary mapping item ID to item name
-        item_id_to_name = {}
-        for item in mapping_data:
-            if 'id' in item and 'name' in item:
-                item_id_to_name[str(item['id'])] = item['name']
-        
-        logger.info(f"Loaded {len(item_id_to_name)} item mappings from mapping.json")
-        return item_id_to_name
+        return read_item_mapping()
     except Exception as e:
         logger.error(f"Error loading item mapping: {e}")
-        return {}  # Return empty dict on error
+        return {}  # Return empty dict on error, the next call retries the read
 
-def get_player_count():
+async def conditional_get(url, parse):
+    """GET a URL, reusing the cached parsed body when the server answers 304 Not Modified."""
+    headers = {}
+    cached = _http_cache.get(url)
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    
+    response = await _HTTP_CLIENT.get(url, headers=headers)
+    if response.status_code == 304 and cached:
+        logger.debug(f"{url} not modified, using cached response")
+        return cached[2]
+    response.raise_for_status()
+    
+    # Only cache responses the server gave us validators for
+    body = parse(response)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        _http_cache[url] = (etag, last_modified, body)
+    return body
+
+async def get_player_count():
     """Fetch the current player count from the OSRS website."""
     try:
         # Fetch the OSRS homepage
-        response = requests.get("https://oldschool.runescape.com/", timeout=10)
-        response.raise_for_status()
-        
-        # Parse the HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Find the player count element
-        player_count_elem = soup.select_one("p.player-count")
-        if not player_count_elem:
-            logger.warning("Player count element not found on OSRS website")
-            return "N/A"
+        html = await conditional_get("https://oldschool.runescape.com/", lambda r: r.content)
         
-        # Extract the number from the text
-        player_count_text = player_count_elem.text
-        match = re.search(r'(\d{1,3}(?:,\d{3})*)', player_count_text)
+        # Extract the number from the player count element
+        match = _PLAYER_RE.search(html)
         if match:
-            # Remove commas from the number and convert to integer
-            player_count = match.group(1).replace(',', '')
+            # Remove commas from the number
+            player_count = match.group(1).replace(b',', b'').decode()
             logger.info(f"Current player count: {player_count}")
             return player_count
         else:
-            logger.warning(f"Could not extract player count from text: {player_count_text}")
+            logger.warning("Player count not found on OSRS website")
             return "N/A"
             
     except Exception as e:
         logger.error(f"Error fetching player count: {e}")
         return "N/A"
 
-def save_price_data_to_mongo(formatted_data, timestamp):
-    """Save the price data to MongoDB."""
-    client = get_mongo_client()
-    if not client:
-        logger.error("Could not save price data - MongoDB connection failed")
-        return False
-    
+def save_price_data_to_mongo(db, snapshot, documents):
+    """Save the collection snapshot and its per-item price data to MongoDB."""
     try:
-        # Get database and collection
-        db_name = os.environ.get('MONGO_DB', 'runequant')
-        db = client[db_name]
         price_coll = db.price_data
         
-        # Prepare documents for insertion
-        documents = []
-        for item_id, item_data in formatted_data.items():
-            # Create document with all fields
-            document = {
-                "timestamp": timestamp,
-                "item_id": item_id,
-                "collection_time": datetime.now()
-            }
-            
-            # Add all data fields
-            for key, value in item_data.items():
-                document[key] = value
-                
-            documents.append(document)
+        # Record the shared per-cycle fields once, keyed on the same timestamp as the items
+        db.snapshots.replace_one({"timestamp": snapshot["timestamp"]}, snapshot, upsert=True)
         
-        # Insert documents in batch
+        # Upsert documents keyed on (timestamp, item_id) in unordered, unacknowledged batches
+        # so re-ingesting the same snapshot replaces it instead of duplicating it
         if documents:
-            result = price_coll.insert_many(documents)
-            logger.info(f"Saved {len(result.inserted_ids)} price records to MongoDB")
+            unacked_coll = price_coll.with_options(write_concern=WriteConcern(w=0))
+            for start in range(0, len(documents), WRITE_BATCH_SIZE):
+                unacked_coll.bulk_write(
+                    [
+                        ReplaceOne({"timestamp": doc["timestamp"], "item_id": doc["item_id"]}, doc, upsert=True)
+                        for doc in documents[start:start + WRITE_BATCH_SIZE]
+                    ],
+                    ordered=False
+                )
+            # w=0 means the server never reports write errors back, so this only confirms the send
+            logger.info(f"Sent {len(documents)} price records to MongoDB (unacknowledged)")
             return True
         else:
             logger.warning("No documents to insert")
@@ -170,106 +222,94 @@ def save_price_data_to_mongo(formatted_data, timestamp):
     except Exception as e:
         logger.error(f"Error saving price data to MongoDB: {e}")
         return False
+
+def make_price_document_builder(timestamp, collection_time, item_id_to_name):
+    """Return a function that builds one item's MongoDB document, with the per-cycle fields bound in."""
+    def build_price_document(item_id, values_5m, values_1h):
+        values_5m = values_5m or {}
+        values_1h = values_1h or {}
+        return {
+            "timestamp": timestamp,
+            "item_id": item_id,
+            "collection_time": collection_time,
+            "item_name": item_id_to_name.get(item_id, f"Unknown Item ({item_id})"),
+            "high_price_5m": values_5m.get('avgHighPrice'),
+            "high_volume_5m": values_5m.get('highPriceVolume'),
+            "low_price_5m": values_5m.get('avgLowPrice'),
+            "low_volume_5m": values_5m.get('lowPriceVolume'),
+            "high_price_1h": values_1h.get('avgHighPrice'),
+            "high_volume_1h": values_1h.get('highPriceVolume'),
+            "low_price_1h": values_1h.get('avgLowPrice'),
+            "low_volume_1h": values_1h.get('lowPriceVolume'),
+        }
     
-    finally:
-        client.close()
+    return build_price_document
+
+async def fetch_endpoint(base_url, endpoint):
+    """Fetch a price endpoint from the OSRS wiki API."""
+    try:
+        data = await conditional_get(f"{base_url}/{endpoint}", lambda r: orjson.loads(r.content))
+        logger.debug(f"Fetched {endpoint} prices for timestamp: {data.get('timestamp')}")
+        return data
+    except Exception as e:
+        logger.error(f"Error fetching {endpoint} prices: {e}")
+        return {"data": {}, "timestamp": 0}
 
-def fetch_prices():
+async def fetch_prices(item_id_to_name, db):
     base_url = "https://prices.runescape.wiki/api/v1/osrs"
     
-    # Load the item ID to name mapping
-    item_id_to_name = load_item_mapping()
-    
-    # Get player count from OSRS website
-    player_count = get_player_count()
+    # Fetch player count and 5m/1h prices concurrently
+    player_count, data_5m, data_1h = await asyncio.gather(
+        get_player_count(),
+        fetch_endpoint(base_url, "5m"),
+        fetch_endpoint(base_url, "1h"),
+    )
     
-    # Get 5-minute data
-    try:
-        response_5m = requests.get(f"{base_url}/5m")
-        response_5m.raise_for_status()
-        data_5m = response_5m.json()
-        logger.debug(f"Fetched 5m prices for timestamp: {data_5m.get('timestamp')}")
-    except Exception as e:
-        logger.error(f"Error fetching 5m prices: {e}")
-        data_5m = {"data": {}, "timestamp": 0}
-        
-    # Get 1-hour data
-    try:
-        response_1h = requests.get(f"{base_url}/1h")
-        response_1h.raise_for_status()
-        data_1h = response_1h.json()
-        logger.debug(f"Fetched 1h prices for timestamp: {data_1h.get('timestamp')}")
-    except Exception as e:
-        logger.error(f"Error fetching 1h prices: {e}")
-        data_1h = {"data": {}, "timestamp": 0}
+    # Read the clock once per cycle and share it between the snapshot and every item
+    collection_time = datetime.now()
     
     # Current timestamp for elapsed time calculation
-    current_timestamp = int(time.time())
+    current_timestamp = int(collection_time.timestamp())
     timestamp_elapsed = current_timestamp - data_5m.get('timestamp', current_timestamp)
     
     # Get GST time
-    gst_time = datetime.now(pytz.timezone('GMT')).strftime('%Y-%m-%d %H:%M:%S GMT')
+    gst_time = collection_time.astimezone(_GMT).strftime('%Y-%m-%d %H:%M:%S GMT')
     
-    # Format the data for all items
-    formatted_data = {}
+    # Build one document per item seen in either endpoint, 5m items first
+    prices_5m = data_5m.get('data', {})
+    prices_1h = data_1h.get('data', {})
+    item_ids = chain(prices_5m, (item_id for item_id in prices_1h if item_id not in prices_5m))
+    # A failed /5m fetch reports timestamp 0; key that cycle on the collection time instead
+    # so its upserts don't overwrite the rows saved by earlier failed cycles
+    timestamp = data_5m.get('timestamp') or current_timestamp
+    build_price_document = make_price_document_builder(timestamp, collection_time, item_id_to_name)
+    documents = [build_price_document(item_id, prices_5m.get(item_id), prices_1h.get(item_id)) for item_id in item_ids]
     
-    # Combine data from both endpoints
-    for item_id, data_5m_values in data_5m.get('data', {}).items():
-        if item_id not in formatted_data:
-            formatted_data[item_id] = {}
-            
-        # Add item name from mapping if available
-        formatted_data[item_id]['item_name'] = item_id_to_name.get(item_id, f"Unknown Item ({item_id})")
-            
-        # Add 5m data
-        formatted_data[item_id]['high_price_5m'] = data_5m_values.get('avgHighPrice')
-        formatted_data[item_id]['high_volume_5m'] = data_5m_values.get('highPriceVolume')
-        formatted_data[item_id]['low_price_5m'] = data_5m_values.get('avgLowPrice')
-        formatted_data[item_id]['low_volume_5m'] = data_5m_values.get('lowPriceVolume')
-        
-        # Add common data
-        formatted_data[item_id]['player_count'] = player_count
-        formatted_data[item_id]['timestampElapsed'] = timestamp_elapsed
-        formatted_data[item_id]['gst'] = gst_time
-    
-    # Add 1h data
-    for item_id, data_1h_values in data_1h.get('data', {}).items():
-        if item_id not in formatted_data:
-            formatted_data[item_id] = {
-                'item_name': item_id_to_name.get(item_id, f"Unknown Item ({item_id})"),
-                'high_price_5m': None,
-                'high_volume_5m': None,
-                'low_price_5m': None,
-                'low_volume_5m': None,
-                'player_count': player_count,
-                'timestampElapsed': timestamp_elapsed,
-                'gst': gst_time
-            }
-            
-        # Add 1h data
-        formatted_data[item_id]['high_price_1h'] = data_1h_values.get('avgHighPrice')
-        formatted_data[item_id]['high_volume_1h'] = data_1h_values.get('highPriceVolume')
-        formatted_data[item_id]['low_price_1h'] = data_1h_values.get('avgLowPrice')
-        formatted_data[item_id]['low_volume_1h'] = data_1h_values.get('lowPriceVolume')
+    snapshot = {
+        "timestamp": timestamp,
+        "collection_time": collection_time,
+        "player_count": player_count,
+        "timestamp_elapsed": timestamp_elapsed,
+        "gst": gst_time
+    }
     
     # Save price data to MongoDB with mapped item names
-    save_price_data_to_mongo(formatted_data, data_5m.get('timestamp'))
+    save_price_data_to_mongo(db, snapshot, documents)
     
-    # Log some sample data (first 5 items)
-    sample_items = list(formatted_data.keys())[:5]
-    for item_id in sample_items:
-        item_data = formatted_data[item_id]
-        logger.info(f"Item ID: {item_id} - Name: {item_data.get('item_name', 'Unknown')}")
-        for column in WANTED_COLUMNS[1:]:  # Skip item_name as we already logged it
-            logger.info(f"  {column}: {item_data.get(column, 'N/A')}")
-        logger.info("---")
+    # Log the snapshot and some sample data (first 5 items), one message each
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(" | ".join(f"{column}: {snapshot[column]}" for column in SNAPSHOT_COLUMNS))
+        for item_data in documents[:5]:
+            lines = [f"Item ID: {item_data['item_id']} - Name: {item_data.get('item_name', 'Unknown')}"]
+            lines += [f"  {column}: {item_data.get(column, 'N/A')}" for column in WANTED_COLUMNS[1:]]  # Skip item_name as we already logged it
+            logger.info("\n".join(lines))
     
     # Log summary
-    logger.info(f"Total items processed: {len(formatted_data)}")
+    logger.info(f"Total items processed: {len(documents)}")
     
-    return formatted_data
+    return documents
 
-def main():
+async def main():
     logger.info("Starting Grand Exchange price tracker")
     
     # Initialize the database
@@ -277,10 +317,24 @@ def main():
         logger.error("Database initialization failed, exiting...")
         return
     
-    # Collect data at regular intervals
-    while True:
-        fetch_prices()
-        time.sleep(300)  # Fetch every 5 minutes
+    # Open the database once for the whole run
+    db = get_mongo_client()[os.environ.get('MONGO_DB', 'runequant')]
+    
+    # Collect data at fixed ticks so the schedule doesn't drift by each cycle's duration
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    try:
+        while True:
+            # The mapping is cached after the first successful read, so this only re-reads after a failure
+            await fetch_prices(load_item_mapping(), db)
+            
+            # Skip any ticks a slow cycle overran
+            next_tick += FETCH_INTERVAL
+            while next_tick <= loop.time():
+                next_tick += FETCH_INTERVAL
+            await asyncio.sleep(next_tick - loop.time())
+    finally:
+        await _HTTP_CLIENT.aclose()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())